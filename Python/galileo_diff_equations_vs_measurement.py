@@ -19,12 +19,45 @@ https://phys.libretexts.org/Bookshelves/University_Physics/University_Physics_I_
 
 """
 
+import math
 import pandas as pd
 import numpy as np
-from scipy.integrate import solve_ivp
+from numba import njit
 import plotly.graph_objs as go
 import plotly.io as pio
 
+# Fixed-step RK4 integration of the equations of motion, compiled with Numba.
+# The whole time loop runs as native code (no solver callbacks). The explicit
+# signature makes Numba compile it (or load it from the on-disk cache) when
+# the script starts rather than on the first call:
+#   dtheta_dt = omega
+#   domega_dt = -(b * omega + M * g * d * sin(theta)) / J
+@njit("float64[:](float64[:], float64, float64, float64, float64, float64, float64, float64, int64)",
+      cache=True, fastmath=True)
+def rk4_sim(t_eval, theta0, omega0, b, M, g, d, J, n_sub):
+    n = t_eval.size
+    theta = np.empty(n)
+    h = (t_eval[1] - t_eval[0]) / n_sub
+    k = M * g * d / J
+    c = b / J
+    th = theta0
+    om = omega0
+    theta[0] = th
+    for i in range(1, n):
+        for _ in range(n_sub):
+            k1_th = om
+            k1_om = -c * om - k * math.sin(th)
+            k2_th = om + 0.5 * h * k1_om
+            k2_om = -c * k2_th - k * math.sin(th + 0.5 * h * k1_th)
+            k3_th = om + 0.5 * h * k2_om
+            k3_om = -c * k3_th - k * math.sin(th + 0.5 * h * k2_th)
+            k4_th = om + h * k3_om
+            k4_om = -c * k4_th - k * math.sin(th + h * k3_th)
+            th += h / 6.0 * (k1_th + 2.0 * k2_th + 2.0 * k3_th + k4_th)
+            om += h / 6.0 * (k1_om + 2.0 * k2_om + 2.0 * k3_om + k4_om)
+        theta[i] = th
+    return theta
+
 # Global variables:
 truncate_csv_time = True
 csv_filename = './csv_data/galileo_2024-07-19_15-25-54.csv'
@@ -47,21 +80,18 @@ omega_0 = 0.5  # Initial angular velocity
 
 # Time span for simulation
 t_span = (0, 60)  # 0 to 60 seconds
-t_eval = np.linspace(t_span[0], t_span[1], 2000)  # Time points where the solution is evaluated
+h = 0.06          # Output time step (about 1000 points over the time span, enough for plotting)
+t_eval = np.arange(t_span[0], t_span[1] + 1e-9, h)  # Time points where the solution is evaluated
 
-# Differential equations
-def equations(t, y):
-    theta, omega = y
-    dtheta_dt = omega
-    domega_dt = -(b * omega + M * g * d * np.sin(theta)) / J
-    return [dtheta_dt, domega_dt]
+# Number of RK4 sub-steps taken between two consecutive points of t_eval
+rk4_substeps = 4
 
 # Solve the differential equations
-sol = solve_ivp(equations, t_span, [theta_0, omega_0], t_eval=t_eval)
+theta_rad = rk4_sim(t_eval, theta_0, omega_0, b, M, g, d, J, rk4_substeps)
 
 # Extract the results
-t_sim = sol.t
-theta_sim = np.rad2deg(sol.y[0])  # Convert the simulation results to degrees
+t_sim = t_eval
+theta_sim = np.rad2deg(theta_rad)  # Convert the simulation results to degrees
 
 # Read the CSV file
 data = pd.read_csv(csv_filename)
@@ -6,63 +6,129 @@ Created on Thu Jul 11 08:01:57 2024
 """
 
 #%% Imports
+import math
 import numpy as np
 import pandas as pd
+from numba import njit, prange, types
 from scipy.optimize import curve_fit
-import scipy.fftpack
+from scipy.fft import rfft, rfftfreq, next_fast_len
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 import plotly.io as pio
 pio.renderers.default = 'browser'
 
+# Optional: if pyFFTW is installed, use FFTW as the backend of scipy.fft (with
+# its plan cache enabled, so repeated transforms of the same length reuse the
+# plan). Otherwise scipy's built-in FFT is used.
+try:
+    import pyfftw.interfaces.cache
+    import pyfftw.interfaces.scipy_fft
+    import scipy.fft
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(60)
+    scipy.fft.set_global_backend(pyfftw.interfaces.scipy_fft)
+except ImportError:
+    pass
+
 
 #%% Functions
+# The Numba functions below are compiled for explicit signatures, so the
+# compilation happens (or is loaded from the on-disk cache) when the script
+# is imported, not on the first call from inside curve_fit. Input arrays are
+# declared read-only because pandas returns read-only views of the CSV
+# columns (writable arrays are accepted as well).
+float64_ro_array = types.Array(types.float64, 1, 'A', readonly=True)
+
+@njit(types.int64(float64_ro_array), cache=True)
+def first_positive_zero_crossing(a):
+    # Index of the first sample where sign(a) increases, i.e. the same index
+    # as np.where(np.diff(np.sign(a)) > 0)[0][0], but the scan stops at the
+    # first crossing instead of building three full-length temporary arrays.
+    # Returns -1 if there is no positive zero crossing.
+    for i in range(a.size - 1):
+        if (a[i] < 0.0 and a[i + 1] >= 0.0) or (a[i] == 0.0 and a[i + 1] > 0.0):
+            return i
+    return -1
+
 def read_and_process_csv(filename):
-    # Read the CSV file
-    data = pd.read_csv(filename)
-    
-    # Ensure the CSV has the correct columns
-    if 'Time' not in data.columns or 'Angle' not in data.columns:
-        raise ValueError("CSV file must contain 'Time' and 'Angle' columns")
+    # Read the 'Time' and 'Angle' columns of the CSV file directly as floats
+    # (usecols raises a ValueError if one of them is missing)
+    data = pd.read_csv(filename, usecols=['Time', 'Angle'], dtype=np.float64, engine='c')
     
-    time = data['Time'].values
-    angle = data['Angle'].values
+    time = data['Time'].to_numpy(copy=False)
+    angle = data['Angle'].to_numpy(copy=False)
     
     # Find the first positive zero crossing
-    zero_crossings = np.where(np.diff(np.sign(angle)) > 0)[0]
+    first_zero_crossing = first_positive_zero_crossing(angle)
     
-    if len(zero_crossings) == 0:
+    if first_zero_crossing == -1:
         raise ValueError("No positive zero crossing found in the data")
     
-    first_zero_crossing = zero_crossings[0]
-    
     # Strip data until the first positive zero crossing
     time = time[first_zero_crossing:] - time[first_zero_crossing]
     angle = angle[first_zero_crossing:]
     
     return time, angle
 
+@njit(types.float64[:](float64_ro_array, types.float64, types.float64, types.float64,
+                        types.float64, types.float64, types.float64, types.float64),
+      cache=True, parallel=True, fastmath=True)
 def sinusoidal_with_exponential_decay(t, A1, A2, theta1, theta2, omega, phi, B):
-    return ((A1 * np.exp(-theta1 * t)) + (A2 * np.exp(-theta2 * t**2))) * np.sin(omega * t - phi) + B
-
-def fit_data(time, angle):
-    # Initial guess for the parameters
-    A1_guess = (np.max(angle) - np.min(angle)) / 2
-    A2_guess = (np.max(angle) - np.min(angle)) / 2
-    theta1_guess = 0.05           # Small decay
-    theta2_guess = 0.05           # Small decay
-    omega_guess = 2 * np.pi / 1   # Approximate frequency
+    # Evaluated in a single compiled pass over t (no full-length temporaries)
+    out = np.empty(t.size)
+    for i in prange(t.size):
+        ti = t[i]
+        out[i] = ((A1 * math.exp(-theta1 * ti)) + (A2 * math.exp(-theta2 * ti * ti))) * math.sin(omega * ti - phi) + B
+    return out
+
+def sinusoidal_with_exponential_decay_jacobian(t, A1, A2, theta1, theta2, omega, phi, B):
+    # Analytic partial derivatives of the model with respect to each parameter
+    e1 = np.exp(-theta1 * t)
+    e2 = np.exp(-theta2 * t**2)
+    envelope = A1 * e1 + A2 * e2
+    s = np.sin(omega * t - phi)
+    c = np.cos(omega * t - phi)
+    jac = np.empty((t.size, 7))
+    jac[:, 0] = e1 * s                      # d/dA1
+    jac[:, 1] = e2 * s                      # d/dA2
+    jac[:, 2] = -A1 * t * e1 * s            # d/dtheta1
+    jac[:, 3] = -A2 * t**2 * e2 * s         # d/dtheta2
+    jac[:, 4] = envelope * t * c            # d/domega
+    jac[:, 5] = -envelope * c               # d/dphi
+    jac[:, 6] = 1.0                         # d/dB
+    return jac
+
+def fit_data(time, angle, amp_fft, period_fft):
+    # Initial guess for the parameters, seeded from the FFT peak. The two
+    # decay terms get different amplitudes and rates so that they are
+    # distinguishable from the first iteration (identical guesses make their
+    # Jacobian columns equal and the problem rank-deficient)
+    A1_guess = 0.7 * amp_fft
+    A2_guess = 0.3 * amp_fft
+    theta1_guess = 0.02           # Small decay
+    theta2_guess = 0.002          # Small decay
+    omega_guess = 2 * np.pi / period_fft
     phi_guess = 0.0
     B_guess = 0.0
 
     initial_guess = [A1_guess, A2_guess, theta1_guess, theta2_guess, omega_guess, phi_guess, B_guess]
 
+    # Bounds: amplitudes, decay rates and frequency are positive, phase within
+    # one turn and offset within +/-90°
+    bounds = ([0, 0, 0, 0, 0, -np.pi, -90], [np.inf] * 5 + [np.pi, 90])
+
     # Curve fitting
-    popt, pcov = curve_fit(sinusoidal_with_exponential_decay, time, angle, p0=initial_guess)
+    popt, pcov, infodict, mesg, ier = curve_fit(sinusoidal_with_exponential_decay, time, angle, p0=initial_guess,
+                                                jac=sinusoidal_with_exponential_decay_jacobian, bounds=bounds,
+                                                check_finite=False, xtol=1e-6, ftol=1e-6, full_output=True)
     
     A1, A2, theta1, theta2, omega, phi, B = popt
     
-    return A1, A2, theta1, theta2, omega, phi, B
+    # Fitted curve: 'fvec' holds the residuals model(time) - angle at the
+    # solution, so the model does not need to be evaluated again
+    angle_fit = angle + infodict['fvec']
+    
+    return A1, A2, theta1, theta2, omega, phi, B, angle_fit
 
 def calculate_r_squared(angle, angle_fit):
     residuals = angle - angle_fit
@@ -75,19 +141,16 @@ def compute_period_via_fft(time, angle):
     # Number of sample points
     N = len(time)
     
-    # Increased number of sample points for higher resolution
-    N_high_res = N * 20
+    # Increased number of sample points for higher resolution (rounded up to
+    # a length the FFT can factor efficiently)
+    N_high_res = next_fast_len(N * 20, real=True)
     
     # Sample spacing
     T = time[1] - time[0]
     
-    # Perform FFT with zero-padding
-    yf = scipy.fftpack.fft(angle, N_high_res)
-    xf = np.fft.fftfreq(N_high_res, T)
-    
-    # Only keep the positive frequencies
-    xf = xf[:N_high_res//2]
-    yf = 2.0/N * np.abs(yf[:N_high_res//2])
+    # Perform real FFT with zero-padding (positive frequencies only)
+    yf = 2.0/N * np.abs(rfft(angle, N_high_res))
+    xf = rfftfreq(N_high_res, T)
     
     # Identify the peak in the FFT amplitude spectrum
     idx_peak = np.argmax(yf)
@@ -101,16 +164,17 @@ def compute_period_via_fft(time, angle):
 
 def analyze_and_plot_csv(filename):
     time, angle = read_and_process_csv(filename)
-    A1, A2, theta1, theta2, omega, phi, B = fit_data(time, angle)
-    period_fit = 2 * np.pi / omega
-    freq = 1/period_fit
     
-    # Compute period via FFT
+    # Compute period via FFT (also used to seed the fit)
     period_fft, xf, yf = compute_period_via_fft(time, angle)
+    amp_fft = yf.max()
+    
+    A1, A2, theta1, theta2, omega, phi, B, angle_fit = fit_data(time, angle, amp_fft, period_fft)
+    period_fit = 2 * np.pi / omega
+    freq = 1/period_fit
     
-    # Generate data points for the fitted curve
+    # Time points of the fitted curve
     t_fit = time
-    angle_fit = sinusoidal_with_exponential_decay(t_fit, A1, A2, theta1, theta2, omega, phi, B)
     
     # Calculate R^2
     r_squared = calculate_r_squared(angle, angle_fit)
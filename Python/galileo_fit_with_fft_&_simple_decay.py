@@ -6,43 +6,90 @@ Created on Thu Jul 11 08:01:57 2024
 """
 
 #%% Imports
+import math
 import numpy as np
 import pandas as pd
+from numba import njit, prange, types
 from scipy.optimize import curve_fit
-import scipy.fftpack
+from scipy.fft import rfft, rfftfreq, next_fast_len
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 import plotly.io as pio
 pio.renderers.default = 'browser'
 
+# Optional: if pyFFTW is installed, use FFTW as the backend of scipy.fft (with
+# its plan cache enabled, so repeated transforms of the same length reuse the
+# plan). Otherwise scipy's built-in FFT is used.
+try:
+    import pyfftw.interfaces.cache
+    import pyfftw.interfaces.scipy_fft
+    import scipy.fft
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(60)
+    scipy.fft.set_global_backend(pyfftw.interfaces.scipy_fft)
+except ImportError:
+    pass
+
 #%% Functions
+# The Numba functions below are compiled for explicit signatures, so the
+# compilation happens (or is loaded from the on-disk cache) when the script
+# is imported, not on the first call from inside curve_fit. Input arrays are
+# declared read-only because pandas returns read-only views of the CSV
+# columns (writable arrays are accepted as well).
+float64_ro_array = types.Array(types.float64, 1, 'A', readonly=True)
+
+@njit(types.int64(float64_ro_array), cache=True)
+def first_positive_zero_crossing(a):
+    # Index of the first sample where sign(a) increases, i.e. the same index
+    # as np.where(np.diff(np.sign(a)) > 0)[0][0], but the scan stops at the
+    # first crossing instead of building three full-length temporary arrays.
+    # Returns -1 if there is no positive zero crossing.
+    for i in range(a.size - 1):
+        if (a[i] < 0.0 and a[i + 1] >= 0.0) or (a[i] == 0.0 and a[i + 1] > 0.0):
+            return i
+    return -1
+
 def read_and_process_csv(filename):
-    # Read the CSV file
-    data = pd.read_csv(filename)
-    
-    # Ensure the CSV has the correct columns
-    if 'Time' not in data.columns or 'Angle' not in data.columns:
-        raise ValueError("CSV file must contain 'Time' and 'Angle' columns")
+    # Read the 'Time' and 'Angle' columns of the CSV file directly as floats
+    # (usecols raises a ValueError if one of them is missing)
+    data = pd.read_csv(filename, usecols=['Time', 'Angle'], dtype=np.float64, engine='c')
     
-    time = data['Time'].values
-    angle = data['Angle'].values
+    time = data['Time'].to_numpy(copy=False)
+    angle = data['Angle'].to_numpy(copy=False)
     
     # Find the first positive zero crossing
-    zero_crossings = np.where(np.diff(np.sign(angle)) > 0)[0]
+    first_zero_crossing = first_positive_zero_crossing(angle)
     
-    if len(zero_crossings) == 0:
+    if first_zero_crossing == -1:
         raise ValueError("No positive zero crossing found in the data")
     
-    first_zero_crossing = zero_crossings[0]
-    
     # Strip data until the first positive zero crossing
     time = time[first_zero_crossing:] - time[first_zero_crossing]
     angle = angle[first_zero_crossing:]
     
     return time, angle
 
+@njit(types.float64[:](float64_ro_array, types.float64, types.float64, types.float64, types.float64, types.float64),
+      cache=True, parallel=True, fastmath=True)
 def sinusoidal_with_exponential_decay(t, A, omega, theta, phi, B):
-    return A * np.exp(-theta * t) * np.sin(omega * t - phi) + B
+    # Evaluated in a single compiled pass over t (no full-length temporaries)
+    out = np.empty(t.size)
+    for i in prange(t.size):
+        out[i] = A * math.exp(-theta * t[i]) * math.sin(omega * t[i] - phi) + B
+    return out
+
+def sinusoidal_with_exponential_decay_jacobian(t, A, omega, theta, phi, B):
+    # Analytic partial derivatives of the model with respect to each parameter
+    e = np.exp(-theta * t)
+    s = np.sin(omega * t - phi)
+    c = np.cos(omega * t - phi)
+    jac = np.empty((t.size, 5))
+    jac[:, 0] = e * s               # d/dA
+    jac[:, 1] = A * t * e * c       # d/domega
+    jac[:, 2] = -A * t * e * s      # d/dtheta
+    jac[:, 3] = -A * e * c          # d/dphi
+    jac[:, 4] = 1.0                 # d/dB
+    return jac
 
 def fit_data(time, angle):
     # Initial guess for the parameters
@@ -55,11 +102,17 @@ def fit_data(time, angle):
     initial_guess = [A_guess, omega_guess, theta_guess, phi_guess, B_guess]
 
     # Curve fitting
-    popt, pcov = curve_fit(sinusoidal_with_exponential_decay, time, angle, p0=initial_guess)
+    popt, pcov, infodict, mesg, ier = curve_fit(sinusoidal_with_exponential_decay, time, angle, p0=initial_guess,
+                                                jac=sinusoidal_with_exponential_decay_jacobian,
+                                                check_finite=False, xtol=1e-6, ftol=1e-6, full_output=True)
     
     A, omega, theta, phi, B = popt
     
-    return A, omega, theta, phi, B
+    # Fitted curve: 'fvec' holds the residuals model(time) - angle at the
+    # solution, so the model does not need to be evaluated again
+    angle_fit = angle + infodict['fvec']
+    
+    return A, omega, theta, phi, B, angle_fit
 
 def calculate_r_squared(angle, angle_fit):
     residuals = angle - angle_fit
@@ -72,19 +125,16 @@ def compute_period_via_fft(time, angle):
     # Number of sample points
     N = len(time)
     
-    # Increased number of sample points for higher resolution
-    N_high_res = N * 20
+    # Increased number of sample points for higher resolution (rounded up to
+    # a length the FFT can factor efficiently)
+    N_high_res = next_fast_len(N * 20, real=True)
     
     # Sample spacing
     T = time[1] - time[0]
     
-    # Perform FFT with zero-padding
-    yf = scipy.fftpack.fft(angle, N_high_res)
-    xf = np.fft.fftfreq(N_high_res, T)
-    
-    # Only keep the positive frequencies
-    xf = xf[:N_high_res//2]
-    yf = 2.0/N * np.abs(yf[:N_high_res//2])
+    # Perform real FFT with zero-padding (positive frequencies only)
+    yf = 2.0/N * np.abs(rfft(angle, N_high_res))
+    xf = rfftfreq(N_high_res, T)
     
     # Identify the peak in the FFT amplitude spectrum
     idx_peak = np.argmax(yf)
@@ -97,7 +147,7 @@ def compute_period_via_fft(time, angle):
 
 def analyze_and_plot_csv(filename):
     time, angle = read_and_process_csv(filename)
-    A, omega, theta, phi, B = fit_data(time, angle)
+    A, omega, theta, phi, B, angle_fit = fit_data(time, angle)
     period_fit = 2 * np.pi / omega
     freq_fit = 1/period_fit
     phi_deg = phi * 180/np.pi
@@ -106,9 +156,8 @@ def analyze_and_plot_csv(filename):
     period_fft, xf, yf = compute_period_via_fft(time, angle)
     freq_fft = 1/period_fft
     
-    # Generate data points for the fitted curve
+    # Time points of the fitted curve
     t_fit = time
-    angle_fit = sinusoidal_with_exponential_decay(t_fit, A, omega, theta, phi, B)
     
     # Calculate R^2
     r_squared = calculate_r_squared(angle, angle_fit)
@@ -9,41 +9,142 @@ __version__ = '1.1.0'
 
 #%% Imports
 import sys
-import re
 import os
+import math
+import time
+import functools
+import collections
 from PyQt5.QtWidgets import QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, QWidget, QPushButton, QComboBox, QCheckBox, QLabel, QRadioButton, QButtonGroup, QGroupBox
-from PyQt5.QtCore import QTimer, QThread, pyqtSignal
+from PyQt5.QtCore import QTimer, QThread
 import pyqtgraph as pg
 import serial
+import serial.threaded
 import serial.tools.list_ports
 import datetime
+import numpy as np
 from scipy.io import savemat
 
 #%%
-# Global flag to reset the time axis when "Clear plot" button is pressed
-# (variable shared between SerialReader and MainWindow classes):
-this_is_the_first_read = True
+# A batch of samples is handed to the GUI when it holds this many samples or
+# when this many seconds have passed since the previous one (the GUI timer
+# drains the batches every 50 ms, handing them over more often would not show
+# the samples sooner):
+BATCH_SIZE = 64
+BATCH_PERIOD = 0.05
+
+# Same for the raw data printed to the console (when enabled):
+RAW_PRINT_SIZE = 32
+RAW_PRINT_PERIOD = 0.1
+
+# Fixed format of the lines sent by the Arduino: b"Time: <ms> ms, Angle: <deg>"
+LINE_PREFIX = b"Time: "
+LINE_SEPARATOR = b" ms, Angle: "
+
+#%% Helper functions
+@functools.lru_cache(maxsize=None)
+def format_port(device, description):
+    # Label of a serial port in the combo box (long descriptions are truncated)
+    return f"{device} ({description[:15]}{'...' if len(description) > 15 else ''})"
+
+#%% Serial port reader classes
+class LineProtocol(serial.threaded.Packetizer):
+    # pyserial protocol: splits the received bytes into lines and hands each
+    # complete line to the SerialReader (runs in pyserial's reader thread)
+    TERMINATOR = b'\n'
+
+    def __init__(self, reader):
+        super().__init__()
+        self.reader = reader
 
-#%% Serial port thread class
-class SerialReader(QThread):
-    data_received = pyqtSignal(float, float)  # Signal to send time and angle data
+    def handle_packet(self, packet):
+        self.reader.handle_line(packet)
 
-    def __init__(self, port='COM9', baudrate=115200, show_raw_data_checkbox=None, parent=None):
-        super().__init__(parent)
+    def connection_lost(self, exc):
+        self.transport = None
+        if exc is not None:
+            print(f"Serial port error: {exc}")
+
+class PortReaderThread(serial.threaded.ReaderThread):
+    # pyserial's reader thread, which also opens the port before running the
+    # read loop (opening can take a while, e.g. for Bluetooth or USB COM ports
+    # on Windows, so it must not block the GUI)
+    def __init__(self, reader):
+        super().__init__(reader.serial_port, lambda: LineProtocol(reader))
+        self.reader = reader
+
+    def run(self):
+        if not self.reader.open_port():
+            self.alive = False
+            return
+        if not self.alive:  # Stopped while the port was being opened
+            self.serial.close()
+            return
+
+        # Same read loop as ReaderThread.run, except that a read timeout (no
+        # byte received for 20 ms) lets the reader deliver what it still holds.
+        # The port's short timeout also keeps stop() quick.
+        self.protocol = self.protocol_factory()
+        self.protocol.connection_made(self)
+        self._connection_made.set()
+        error = None
+        while self.alive and self.serial.is_open:
+            try:
+                # Read all that is there or wait for one byte (until the timeout)
+                data = self.serial.read(self.serial.in_waiting or 1)
+            except serial.SerialException as e:
+                error = e  # Probably a disconnected USB-serial adapter
+                break
+            try:
+                if data:
+                    self.protocol.data_received(data)
+                else:
+                    self.reader.flush_due()
+            except Exception as e:
+                error = e
+                break
+        self.alive = False
+        self.protocol.connection_lost(error)
+        self.protocol = None
+
+class SerialReader:
+    def __init__(self, port='COM9', baudrate=115200, show_raw_data=False):
         self.port = port
         self.baudrate = baudrate
-        self.show_raw_data_checkbox = show_raw_data_checkbox
-        self.running = True
+        self.show_raw_data = show_raw_data  # Mirrors the GUI checkbox (never read Qt widgets from the reader thread)
         self.previous_time = -1
-        self.startup_time = 0
-        self.pattern = re.compile(r"Time:\s(\d+)\sms,\sAngle:\s([-\d.]+)")
+        # The first parsed line sets the time origin. reset() (GUI thread)
+        # bumps the generation; the reader thread re-syncs the origin on its
+        # next line and tags each batch with the generation of its samples,
+        # so the GUI can drop batches parsed before the reset:
+        self.generation = 0
+        self._generation = -1    # Generation of the current origin and batch
+        self._startup_ms = 0
+        self.batch = []          # Parsed (time, angle) samples not handed to the GUI yet
+        self.last_push = time.monotonic()
+        # (generation, array of [time, angle] rows) batches waiting to be drained
+        # by the GUI timer. deque.append/popleft are thread-safe, no Qt signal needed:
+        self.queue = collections.deque()
+        self.raw_lines = []      # Raw data lines not printed to the console yet
+        self.last_raw_print = time.monotonic()
+        self.serial_port = None
+        self.reader_thread = None
+
+    def start(self):
+        try:
+            # Short read timeout, so the reader thread stops quickly when asked to
+            self.serial_port = serial.serial_for_url(self.port, self.baudrate, timeout=0.02, do_not_open=True)
+        except serial.SerialException as e:
+            print(f"Error opening serial port: {e}")
+            self.serial_port = None
+            return
 
-    def run(self):
-        global this_is_the_first_read
+        # The reader thread opens the port, runs the read loop and splits the lines:
+        self.reader_thread = PortReaderThread(self)
+        self.reader_thread.start()
 
+    def open_port(self):
+        # Runs in the reader thread. Returns True if the port was opened.
         try:
-            self.serial_port = serial.serial_for_url(self.port, self.baudrate, timeout=1, do_not_open=True)
-
             # Disable DTR and RTS to prevent the Arduino from resetting:
             self.serial_port.dtr = False
             self.serial_port.rts = False
@@ -54,47 +155,128 @@ class SerialReader(QThread):
             # Flush the serial port buffer
             self.serial_port.flushInput()
             
+            # Ask the driver to deliver received bytes immediately (Linux only,
+            # and not supported by every USB-serial driver):
+            if hasattr(self.serial_port, 'set_low_latency_mode'):
+                try:
+                    self.serial_port.set_low_latency_mode(True)
+                except ValueError:
+                    pass
+            
             # Print port status:
             print(f"Opened serial port {self.port} at {self.baudrate} baud.")
             
         except serial.SerialException as e:
             print(f"Error opening serial port: {e}")
-            self.serial_port = None
+            return False
+        return True
+
+    def reset(self):
+        self.generation += 1
+
+    def handle_line(self, line):
+        # Parse with plain bytes methods (the format is fixed, no regex needed):
+        if not line.startswith(LINE_PREFIX):
             return
+        time_str, separator, angle_str = line[len(LINE_PREFIX):].partition(LINE_SEPARATOR)
+        if not separator:
+            return
+        try:
+            arduino_time_ms = int(time_str)
+            angle = float(angle_str)
+        except ValueError:
+            return  # Skip this line if it is corrupted
+        if not math.isfinite(angle):
+            return  # float() also accepts 'nan' and 'inf'
+
+        generation = self.generation
+        if generation != self._generation:
+            self._startup_ms = arduino_time_ms
+            self._generation = generation
+            self.previous_time = -1
+            self.batch.clear()  # Drop samples parsed before the reset
+            time_ms = 0
+        else:
+            time_ms = arduino_time_ms - self._startup_ms
 
-        while self.running:
-            if self.serial_port and self.serial_port.in_waiting > 0:
-                try:
-                    line = self.serial_port.readline().decode('utf-8').strip()
-                except UnicodeDecodeError:
-                    continue  # Skip this line if there's a decode error
-                match = self.pattern.match(line)
-                if match:
-                    if this_is_the_first_read:                       
-                        self.startup_time = int(match.group(1))
-                        this_is_the_first_read = False
-                        time_ms = 0
-                    else:
-                        time_ms = int(match.group(1)) - self.startup_time
-
-                    if time_ms == self.previous_time:
-                        continue # Skip line if it already parsed (not sure if it necessary)
-                    
-                    angle = float(match.group(2))
-                    self.previous_time = time_ms
-                    time_s = time_ms / 1000.0
-                    self.data_received.emit(time_s, angle)
-                    
-                    if self.show_raw_data_checkbox.isChecked():
-                        print(f"Parsed data: Time: {time_s}s, Angle: {angle}°")
-
-        if self.serial_port:
-            self.serial_port.close()
-            print("Closed serial port.")
+        if time_ms == self.previous_time:
+            return # Skip line if it already parsed (not sure if it necessary)
+        
+        self.previous_time = time_ms
+        time_s = time_ms / 1000.0
+        self.batch.append((time_s, angle))
+        
+        # Print to the console in chunks rather than one write per sample:
+        if self.show_raw_data:
+            self.raw_lines.append(f"Parsed data: Time: {time_s}s, Angle: {angle}°\n")
+            if len(self.raw_lines) >= RAW_PRINT_SIZE:
+                self.print_raw_lines()
+
+        # Hand the samples to the GUI in batches rather than one by one:
+        if len(self.batch) >= BATCH_SIZE:
+            self.push_batch()
+
+        self.flush_due()
+
+    def flush(self):
+        # Deliver the samples and raw lines still pending
+        if self.batch:
+            self.push_batch()
+        if self.raw_lines:
+            self.print_raw_lines()
+
+    def flush_due(self):
+        # Deliver the samples and raw lines that have waited their period
+        # (called per line and when a read times out, i.e. the port is quiet)
+        now = time.monotonic()
+        if self.batch and now - self.last_push >= BATCH_PERIOD:
+            self.push_batch()
+        if self.raw_lines and now - self.last_raw_print >= RAW_PRINT_PERIOD:
+            self.print_raw_lines()
+
+    def push_batch(self):
+        self.queue.append((self._generation, np.array(self.batch)))
+        self.batch = []
+        self.last_push = time.monotonic()
+
+    def print_raw_lines(self):
+        sys.stdout.write(''.join(self.raw_lines))
+        sys.stdout.flush()
+        self.raw_lines = []
+        self.last_raw_print = time.monotonic()
 
     def stop(self):
-        self.running = False
-        self.wait()
+        if self.reader_thread is None:
+            return
+        port_was_open = self.serial_port.is_open  # False if open_port() failed
+        self.reader_thread.close()  # Stops the reader thread and closes the port
+        self.reader_thread = None
+        self.flush()  # Deliver what was still pending when the thread stopped
+        if port_was_open:
+            print("Closed serial port.")
+
+#%% Data saving thread class
+class DataSaver(QThread):
+    def __init__(self, csv_filename, time, angle, save_mat=False, parent=None):
+        super().__init__(parent)
+        self.csv_filename = csv_filename
+        self.time = time
+        self.angle = angle
+        self.save_mat = save_mat
+
+    def run(self):
+        # Time has millisecond resolution ('%.3f' stays exact for long runs),
+        # angle is written with 6 significant digits. np.savetxt writes row by
+        # row, so give it a large (1 MiB) file buffer to keep write calls few:
+        with open(self.csv_filename, 'w', buffering=1 << 20) as file:
+            np.savetxt(file, np.column_stack((self.time, self.angle)),
+                       fmt=('%.3f', '%.6g'), delimiter=',', header='Time,Angle', comments='')
+        print(f"Data saved to {self.csv_filename}")
+
+        if self.save_mat:
+            mat_filename = self.csv_filename.rsplit('.', 1)[0] + '.mat'
+            savemat(mat_filename, {'data': {'Time': self.time, 'Angle': self.angle}}, do_compression=True)
+            print(f"Data saved to MAT file at {mat_filename}")
 
 #%% GUI class
 class MainWindow(QMainWindow):
@@ -102,10 +284,18 @@ class MainWindow(QMainWindow):
         super().__init__()
         self.setWindowTitle("From Galileo Galilei to Arduino")  # Set the window title
 
-        self.data = {
-            "Time": [],
-            "Angle": []
-        }
+        # Acquired samples, stored in preallocated arrays whose capacity is a
+        # power of two and doubles when full (only the first self._n entries
+        # are valid):
+        self._cap = 4096
+        self._n = 0
+        self._t = np.empty(self._cap)
+        self._a = np.empty(self._cap)
+        self._dirty = False  # True when samples arrived since the last plot update
+        # Running bounds of the acquired samples, so auto scaling does not
+        # have to scan the whole record:
+        self.reset_bounds()
+        self._auto_scale = True  # Follow the data range until the user pans/zooms
         self.running = True
 
         self.central_widget = QWidget()
@@ -130,6 +320,7 @@ class MainWindow(QMainWindow):
         self.disconnect_button.setEnabled(False)  # Disable the button initially
 
         self.show_raw_data_checkbox = QCheckBox("Show received raw data in the console")
+        self.show_raw_data_checkbox.stateChanged.connect(self.set_show_raw_data)
         
         self.h_layout = QHBoxLayout()
         self.h_layout.addWidget(self.refresh_button)  # Add the refresh button to the layout
@@ -196,6 +387,7 @@ class MainWindow(QMainWindow):
         self.timer.start(50)
 
         self.serial_reader = None
+        self.data_saver = None
 
         # Add the label at the bottom
         self.footer_label = QLabel()
@@ -207,30 +399,38 @@ class MainWindow(QMainWindow):
 
     def get_serial_ports(self):
         ports = serial.tools.list_ports.comports()
-        return [f"{port.device} ({port.description[:15]}...)" if len(port.description) > 15 else f"{port.device} ({port.description})" for port in ports]
+        return [format_port(port.device, port.description) for port in ports]
 
 
     def refresh_ports(self):
-        self.combobox.clear()
-        self.combobox.addItems(self.get_serial_ports())
+        ports = self.get_serial_ports()
+        # Only rebuild the combo box (and lose the selection) if the ports changed:
+        if ports != [self.combobox.itemText(i) for i in range(self.combobox.count())]:
+            self.combobox.clear()
+            self.combobox.addItems(ports)
 
     def connect_and_run(self):
         self.reset_time()  # Clear the plot
         self.auto_scale_xy()  # Reset plot scale
         selected_port = self.combobox.currentText().split()[0]  # Extract the port number
-        show_raw_data_checkbox = self.show_raw_data_checkbox
-        self.serial_reader = SerialReader(port=selected_port, show_raw_data_checkbox=show_raw_data_checkbox)
-        self.serial_reader.data_received.connect(self.add_data_point)
+        show_raw_data = self.show_raw_data_checkbox.isChecked()
+        self.serial_reader = SerialReader(port=selected_port, show_raw_data=show_raw_data)
         self.serial_reader.start()
         
         # Disable the buttons only if the connection is successful
         QTimer.singleShot(1000, self.check_connection_status)
 
+    def set_show_raw_data(self, state):
+        if self.serial_reader is not None:
+            self.serial_reader.show_raw_data = bool(state)
+
     def check_connection_status(self):
         if self.serial_reader and self.serial_reader.serial_port and self.serial_reader.serial_port.is_open:
             self.connect_button.setChecked(True)  # Keep the button pressed
             self.connect_button.setEnabled(False)  # Disable the button
             self.disconnect_button.setEnabled(True)  # Enable the "Disconnect" button
+        elif self.serial_reader and self.serial_reader.reader_thread and self.serial_reader.reader_thread.is_alive():
+            QTimer.singleShot(200, self.check_connection_status)  # Port still being opened
         else:
             self.connect_button.setChecked(False)  # Unpress the button
             self.connect_button.setEnabled(True)  # Enable the button
@@ -238,6 +438,7 @@ class MainWindow(QMainWindow):
     def disconnect(self):
         if self.serial_reader is not None:
             self.serial_reader.stop()
+            self.drain_serial_queue()  # Keep the last samples
             self.serial_reader = None
             print("Disconnected from the serial port.")
         self.connect_button.setChecked(False)  # Unpress the button
@@ -251,35 +452,105 @@ class MainWindow(QMainWindow):
         self.plot_item.setLabel('bottom', 'Time (seconds)', color='black')
         self.plot_item.showGrid(x=True, y=True, alpha=0.5)
 
-    def add_data_point(self, time_s, angle):
-        self.data["Time"].append(time_s)
-        self.data["Angle"].append(angle)
+        # Only draw what fits on screen: peak-preserving (min/max) downsampling
+        # and clipping to the visible x range keep the repaint cost flat for
+        # long acquisitions:
+        self.plot_item.setDownsampling(ds=True, auto=True, mode='peak')
+        self.plot_item.setClipToView(True)
+
+        # Persistent curve, updated in place by update_plot:
+        self.curve = self.plot_item.plot([], [], pen=pg.mkPen(color=(255, 0, 0), width=2))
+        self.curve.setDownsampling(auto=True, method='peak')
+        self.curve.setClipToView(True)
+
+        # Auto scaling is done by update_plot from the running bounds (O(1))
+        # instead of pyqtgraph's auto range, which scans all the data. Panning
+        # or zooming with the mouse stops it until "Auto Scale XY" is pressed:
+        self.plot_item.disableAutoRange()
+        self.plot_item.getViewBox().sigRangeChangedManually.connect(self.stop_auto_scale)
+
+    def add_data_chunk(self, chunk):
+        n_new = len(chunk)
+        if self._n + n_new > self._cap:
+            self.grow_buffers(self._n + n_new)
+        self._t[self._n:self._n + n_new] = chunk[:, 0]
+        self._a[self._n:self._n + n_new] = chunk[:, 1]
+        self._n += n_new
+        self._dirty = True
+        self._tmin = min(self._tmin, chunk[:, 0].min())
+        self._tmax = max(self._tmax, chunk[:, 0].max())
+        self._amin = min(self._amin, chunk[:, 1].min())
+        self._amax = max(self._amax, chunk[:, 1].max())
+
+    def reset_bounds(self):
+        self._tmin = self._amin = np.inf
+        self._tmax = self._amax = -np.inf
+
+    def grow_buffers(self, min_capacity):
+        while self._cap < min_capacity:
+            self._cap *= 2
+        # Copy only the valid samples into the new, larger arrays:
+        t = np.empty(self._cap)
+        a = np.empty(self._cap)
+        t[:self._n], a[:self._n] = self._snapshot()
+        self._t = t
+        self._a = a
+
+    def _snapshot(self):
+        # Views (no copy) of the valid samples. The buffers are only written
+        # by add_data_chunk, which runs in the GUI thread like every reader of
+        # the snapshot, so no lock is needed:
+        return self._t[:self._n], self._a[:self._n]
+
+    def drain_serial_queue(self):
+        queue = self.serial_reader.queue
+        generation = self.serial_reader.generation
+        while queue:
+            batch_generation, chunk = queue.popleft()
+            if batch_generation == generation:  # Skip batches from before a reset
+                self.add_data_chunk(chunk)
 
     def update_plot(self):
-        if not self.running:
+        if self.serial_reader is not None:
+            self.drain_serial_queue()
+
+        # Nothing to redraw if no new samples arrived since the last tick:
+        if not self.running or not self._dirty:
             return
+        self._dirty = False
 
-        self.plot_item.clear()
-        pen = pg.mkPen(color=(255, 0, 0), width=2)
-        self.plot_item.plot(self.data["Time"], self.data["Angle"], pen=pen)
+        # The samples are always finite and contiguous, so pyqtgraph can skip
+        # its finite-value check and draw them as one connected line:
+        t, a = self._snapshot()
+        self.curve.setData(t, a, skipFiniteCheck=True, connect='all')
+        if self._auto_scale:
+            self.apply_auto_scale()
 
     def reset_time(self):
-        global this_is_the_first_read
-        
-        self.data = {
-            "Time": [],
-            "Angle": []
-        }
-        self.plot_item.clear()
-        this_is_the_first_read = True
+        if self.serial_reader is not None:
+            self.serial_reader.reset()
+        self._n = 0
+        self.reset_bounds()
+        self.curve.setData([], [])
 
     def auto_scale_xy(self):
-        self.plot_item.enableAutoRange()
+        self._auto_scale = True
+        self.apply_auto_scale()
+
+    def apply_auto_scale(self):
+        if self._n == 0:
+            return
+        self.plot_item.getViewBox().setRange(xRange=(self._tmin, self._tmax), yRange=(self._amin, self._amax), padding=0.05)
+
+    def stop_auto_scale(self):
+        self._auto_scale = False
 
     def stop_and_quit(self):
         self.running = False
         if self.serial_reader is not None:
             self.serial_reader.stop()
+        if self.data_saver is not None:
+            self.data_saver.wait()  # Let a save in progress finish writing
 
         # self.save_data()  # Save data
         self.close()  # Close the application
@@ -290,16 +561,16 @@ class MainWindow(QMainWindow):
             os.makedirs('./csv_data')
         
         csv_filename = f"./csv_data/galileo_{timestamp}.csv"
-        with open(csv_filename, 'w') as file:
-            file.write("Time,Angle\n")
-            for time, angle in zip(self.data["Time"], self.data["Angle"]):
-                file.write(f"{time},{angle}\n")
-        print(f"Data saved to {csv_filename}")
-
-        if self.export_option_group.checkedId() == 2:  # 'CSV and MAT file' is selected
-            mat_filename = csv_filename.rsplit('.', 1)[0] + '.mat'
-            savemat(mat_filename, {'data': {'Time': self.data["Time"], 'Angle': self.data["Angle"]}})
-            print(f"Data saved to MAT file at {mat_filename}")
+        save_mat = self.export_option_group.checkedId() == 2  # 'CSV and MAT file' is selected
+
+        # Write the file(s) in a background thread so the GUI does not freeze
+        # on long records. The samples are copied because the acquisition
+        # keeps writing into the same buffers:
+        if self.data_saver is not None:
+            self.data_saver.wait()
+        t, a = self._snapshot()
+        self.data_saver = DataSaver(csv_filename, t.copy(), a.copy(), save_mat)
+        self.data_saver.start()
 
     def closeEvent(self, event):
         # Override close event to call stop_and_quit when window is closed
@@ -6,6 +6,7 @@ Created on Thu Jul 11 08:01:57 2024
 """
 
 #%% Imports
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 import plotly.io as pio
@@ -13,23 +14,32 @@ import plotly.io as pio
 # Set default renderer to browser
 pio.renderers.default = 'browser'
 
+# Layout shared by every plot (the template is looked up once, at import):
+_BASE_LAYOUT = dict(
+    xaxis_title='Time (sec)',
+    yaxis_title='Angle (°)',
+    template=pio.templates['seaborn']
+    # template=pio.templates['plotly_dark']
+    # template=pio.templates['plotly_white']
+)
+
 #%% Function
 def read_and_plot_csv(filename):
-    # Read the CSV file
-    data = pd.read_csv(filename)
-    
-    # Ensure the CSV has the correct columns
-    if 'Time' not in data.columns or 'Angle' not in data.columns:
-        raise ValueError("CSV file must contain 'Time' and 'Angle' columns")
+    # Read the 'Time' and 'Angle' columns of the CSV file directly as floats
+    # (usecols raises a ValueError if one of them is missing)
+    data = pd.read_csv(filename, engine='c', usecols=['Time', 'Angle'],
+                       dtype={'Time': np.float64, 'Angle': np.float64})
     
-    time = data['Time']
-    angle = data['Angle']
+    time = data['Time'].to_numpy(copy=False)
+    angle = data['Angle'].to_numpy(copy=False)
     
     # Create the plot
     fig = go.Figure()
     
-    # Add the data trace
-    fig.add_trace(go.Scatter(x=time, y=angle, mode='lines+markers', name='Angle'))
+    # Add the data trace (WebGL, so long records stay responsive in the
+    # browser; markers are dropped above 100k points)
+    mode = 'lines+markers' if len(time) <= 100_000 else 'lines'
+    fig.add_trace(go.Scattergl(x=time, y=angle, mode=mode, name='Angle'))
     
     title =  f'<b>FROM GALILEO GALILEI TO ARDUINO</b><br>'
     title += f'<b><i>ANGLE vs TIME</i></b><br>'
@@ -37,14 +47,7 @@ def read_and_plot_csv(filename):
     title += '<i>' + str(filename) + '</i>'
     
     # Update layout
-    fig.update_layout(
-        title=title,
-        xaxis_title='Time (sec)',
-        yaxis_title='Angle (°)',
-        template='seaborn'
-        # template='plotly_dark'
-        # template='plotly_white'
-    )
+    fig.update_layout(title=title, **_BASE_LAYOUT)
     
     # Show the plot
     fig.show()